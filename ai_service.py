@@ -1,10 +1,26 @@
 import os
+import re
+import sys
 import json
-import uuid
-from typing import List, Dict, Any, Optional
-from fastapi import FastAPI, HTTPException
+import asyncio
+import secrets
+import time
+import functools
+import atexit
+import logging
+import logging.handlers
+import queue
+import contextlib
+from collections import OrderedDict
+import numpy as np
+import msgspec
+import orjson
+import httpx
+from typing import List, Dict, Any, Optional, AsyncIterator
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from langchain_openai import ChatOpenAI
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
 import uvicorn
 from dotenv import load_dotenv
@@ -17,43 +33,400 @@ os.environ["LANGCHAIN_TRACING_V2"] = "true"
 os.environ["LANGCHAIN_API_KEY"] = os.getenv("LANGCHAIN_API_KEY", "")
 os.environ["LANGCHAIN_PROJECT"] = os.getenv("LANGCHAIN_PROJECT", "")
 
-app = FastAPI(title="RAG AI Service", version="1.1.0")
+class JSONLogFormatter(logging.Formatter):
+    """Render log records as single-line JSON, including any `extra` fields."""
+    
+    STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+    
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        payload.update({key: value for key, value in vars(record).items() if key not in self.STANDARD_ATTRS})
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        return orjson.dumps(payload, default=str).decode()
+
+# Log through a queue so request handlers never block on stdout; a background
+# listener thread does the formatting and writing
+log_queue = queue.SimpleQueue()
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(JSONLogFormatter())
+log_listener = logging.handlers.QueueListener(log_queue, log_stream_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+log = logging.getLogger("ai_service")
+log.setLevel(logging.INFO)
+log.addHandler(logging.handlers.QueueHandler(log_queue))
+log.propagate = False
+
+app = FastAPI(title="RAG AI Service", version="1.1.0", default_response_class=ORJSONResponse)
+
+# Per-request timeout for OpenAI calls, in seconds. It must be set on the LangChain
+# wrappers: they always pass their own timeout to the OpenAI client, which overrides
+# any default on the shared httpx client
+OPENAI_TIMEOUT_SECONDS = 60
+
+# Shared keep-alive HTTP/2 connection pool for all async OpenAI calls
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+)
 
 # Initialize OpenAI client
 llm = ChatOpenAI(
     model="gpt-3.5-turbo",
     temperature=0,  # Lower temperature for more consistent responses
     max_tokens=4000,   # Increased for better context handling
-    api_key=os.getenv("OPENAI_API_KEY")
+    api_key=os.getenv("OPENAI_API_KEY"),
+    timeout=OPENAI_TIMEOUT_SECONDS,
+    http_async_client=http_client
 )
 
-# Pydantic models
-class RetrievedChunk(BaseModel):
+# Embeddings used to recognise semantically repeated questions
+embeddings = OpenAIEmbeddings(
+    model="text-embedding-ada-002",
+    api_key=os.getenv("OPENAI_API_KEY"),
+    timeout=OPENAI_TIMEOUT_SECONDS,
+    http_async_client=http_client
+)
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await http_client.aclose()
+
+NO_CONTEXT_ANSWER = "I don't have enough relevant information in the knowledge base to answer your question. Please try rephrasing or ask about a different topic."
+NO_CONTEXT_STEPS = ("Retrieved chunks: 0", "No chunks available - returning no context response")
+
+# Phrases that mark a question as building on the previous exchange
+FOLLOW_UP_PATTERNS = [
+    'and in total', 'in total', 'total?', 'overall?', 'combined?',
+    'and what about', 'what about', 'also', 'additionally',
+    'tell me more', 'more details', 'elaborate'
+]
+
+# Substrings that mark a request for totals or a summary
+SUMMARY_PATTERNS = ['total', 'overall', 'combined', 'sum', 'altogether']
+
+# Any follow-up phrase anywhere, or a question opening with a connective
+FOLLOW_UP_RE = re.compile(
+    "|".join(map(re.escape, FOLLOW_UP_PATTERNS)) + r"|^(?:and |also |what about |how about )"
+)
+SUMMARY_RE = re.compile("|".join(map(re.escape, SUMMARY_PATTERNS)))
+
+# Topic tag -> whole words that signal it in recent conversation (plural forms listed explicitly)
+TOPIC_KEYWORDS = {
+    'charitable_giving': frozenset({'charity', 'charities', 'charitable', 'donation', 'donations', 'donated'}),
+    'insurance': frozenset({'insurance', 'policy', 'policies', 'coverage', 'claim', 'claims'}),
+    'company_info': frozenset({'travelers', 'company', 'companies', 'corporation', 'corporations'}),
+    'golf_sponsorship': frozenset({'golf', 'tournament', 'tournaments', 'championship', 'championships'}),
+    'corporate_actions': frozenset({'repurchase', 'repurchases', 'acquisition', 'acquisitions', 'merger', 'mergers'}),
+    'financial_data': frozenset({'money', 'amount', 'amounts', 'cost', 'costs', 'expense', 'expenses'}),
+}
+
+WORD_RE = re.compile(r"[a-z]+")
+
+ROLE_LABELS = {"user": "USER"}
+
+# Recent messages considered for analysis and prompting (last 3 exchanges)
+MAX_HISTORY_MESSAGES = 6
+
+# Characters of each retrieved chunk included in the prompt
+CHUNK_PREVIEW_CHARS = 300
+
+# System instructions per question kind; kept free of per-request data so the prompt
+# prefix is stable. Provider prompt caching only applies to models that support it and to
+# identical prefixes of at least 1024 tokens; these are ~150 tokens and gpt-3.5-turbo has
+# no prompt caching, so no cache hits are expected with the current setup
+STATIC_SYSTEM_PROMPTS = {
+    'follow_up_summary': """You are an AI assistant with access to conversation history and retrieved documents.
+
+The user is asking for summary/total information as a follow-up to the previous conversation. Your task is to:
+
+1. Review the previous conversation to understand what topic they're asking about
+2. Look through ALL retrieved information for comprehensive data related to that topic
+3. Provide a complete answer that synthesizes information across multiple sources
+4. If asking for totals/sums, look for numerical data and add them up if appropriate
+5. Be thorough but concise
+
+IMPORTANT: Use both the conversation history AND retrieved information to provide a complete answer.""",
+
+    'follow_up': """You are an AI assistant with access to conversation history and retrieved documents.
+
+This is a follow-up question building on the previous conversation. Your task is to:
+
+1. Consider the context from the previous conversation
+2. Use the retrieved information to extend or clarify the previous discussion
+3. Provide additional relevant details that build on what was already discussed
+4. Maintain continuity with the previous conversation
+
+Be direct and informative while building on the established context.""",
+
+    'new': """You are an AI assistant answering questions based on retrieved documents.
+
+Provide a direct, comprehensive answer to the user's question using the retrieved information.
+
+Guidelines:
+- Answer the question completely and accurately
+- Use specific details from the retrieved sources
+- Be concise but thorough
+- If multiple sources contain relevant information, synthesize them appropriately"""
+}
+
+SYSTEM_MESSAGE_FOLLOW_UP_SUMMARY = SystemMessage(content=STATIC_SYSTEM_PROMPTS['follow_up_summary'])
+SYSTEM_MESSAGE_FOLLOW_UP = SystemMessage(content=STATIC_SYSTEM_PROMPTS['follow_up'])
+SYSTEM_MESSAGE_NEW = SystemMessage(content=STATIC_SYSTEM_PROMPTS['new'])
+
+@functools.lru_cache(maxsize=2048)
+def analyze_context_cached(question: str, history_tail: tuple) -> tuple:
+    """Pure conversation analysis over (role, content) pairs, memoized for repeated requests.
+    
+    Returns (is_follow_up, question_type, previous_topics, context_needed, summary_request)
+    as a tuple so cached results stay immutable.
+    """
+    if not history_tail:
+        return (False, 'new', (), False, False)
+    
+    question_lower = question.lower().strip()
+    
+    # Detect follow-up patterns
+    is_follow_up = (
+        FOLLOW_UP_RE.search(question_lower) is not None or
+        len(question.split()) <= 5
+    )
+    
+    # Identify if it's a summary/total request
+    summary_request = SUMMARY_RE.search(question_lower) is not None
+    
+    # Tokenize recent conversation once and intersect with each topic's keywords
+    tokens = set(WORD_RE.findall("\n".join(content for _, content in history_tail).lower()))
+    topics = tuple(topic for topic, keywords in TOPIC_KEYWORDS.items() if not keywords.isdisjoint(tokens))
+    
+    return (is_follow_up, 'new', topics, is_follow_up and len(topics) > 0, summary_request)
+
+def sse_event(payload: Dict[str, Any]) -> str:
+    """Format a payload as a single server-sent event."""
+    return f"data: {json.dumps(payload)}\n\n"
+
+# Request models, decoded straight from the JSON body with msgspec
+class RetrievedChunk(msgspec.Struct, dict=True):
     id: str
     text: str
     score: float
-    searchType: str = None
+    searchType: Optional[str] = None
+    
+    @functools.cached_property
+    def preview(self) -> str:
+        """Chunk text truncated for the prompt, with an ellipsis when cut."""
+        if len(self.text) > CHUNK_PREVIEW_CHARS:
+            return self.text[:CHUNK_PREVIEW_CHARS] + "..."
+        return self.text
 
-class ConversationMessage(BaseModel):
+class ConversationMessage(msgspec.Struct):
     role: str  # 'user' or 'assistant'
     content: str
     timestamp: Optional[str] = None
 
-class GenerationRequest(BaseModel):
+class GenerationRequest(msgspec.Struct):
     question: str
     retrievedChunks: List[RetrievedChunk] = []
     sessionId: Optional[str] = None
     conversationHistory: Optional[List[ConversationMessage]] = []
     maxTokens: int = 400
+    debug: bool = False
+
+generation_request_decoder = msgspec.json.Decoder(GenerationRequest)
 
+async def decode_generation_request(http_request: Request) -> GenerationRequest:
+    """Decode and validate a generation request body, mapping failures to a 422."""
+    try:
+        return generation_request_decoder.decode(await http_request.body())
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=f"Invalid request body: {str(e)}")
+
+# Pydantic models
 class GenerationResponse(BaseModel):
     answer: str
     tokensUsed: int
     model: str
-    processingSteps: List[str]
+    processingSteps: Optional[List[str]] = None  # only populated for debug requests
     sessionId: str
     needsFollowUp: bool = False
 
+class SemanticCache:
+    """LRU cache of generated answers, looked up by question embedding similarity.
+    
+    Candidates are found with random-projection LSH (several tables of sign bits
+    over the embedding) and only among entries generated from the same set of
+    retrieved chunk IDs; a candidate is a hit when its cosine similarity to the
+    new question reaches the threshold.
+    """
+    
+    def __init__(self, dim: int = 1536, num_tables: int = 4, bits_per_table: int = 8,
+                 threshold: float = 0.95, max_entries: int = 10000, ttl_seconds: float = 3600, seed: int = 42):
+        rng = np.random.default_rng(seed)
+        self.planes = rng.standard_normal((num_tables, bits_per_table, dim))
+        self.bit_weights = 1 << np.arange(bits_per_table)
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries: "OrderedDict[int, tuple]" = OrderedDict()
+        self.buckets: Dict[tuple, set] = {}
+        self.next_id = 0
+    
+    def _bucket_keys(self, vector: np.ndarray, chunk_ids: frozenset) -> List[tuple]:
+        signatures = ((self.planes @ vector) > 0) @ self.bit_weights
+        return [(chunk_ids, table, int(signature)) for table, signature in enumerate(signatures)]
+    
+    def _evict(self, entry_id: int):
+        _, _, _, bucket_keys = self.entries.pop(entry_id)
+        for key in bucket_keys:
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self.buckets[key]
+    
+    def lookup(self, vector: np.ndarray, chunk_ids: frozenset) -> Optional[GenerationResponse]:
+        """Return the cached response for a similar question over the same chunks, if any."""
+        now = time.monotonic()
+        candidates = set()
+        for key in self._bucket_keys(vector, chunk_ids):
+            candidates.update(self.buckets.get(key, ()))
+        
+        best_id, best_score = None, self.threshold
+        for entry_id in candidates:
+            cached_vector, response, expires_at, _ = self.entries[entry_id]
+            if expires_at < now:
+                self._evict(entry_id)
+                continue
+            score = float(cached_vector @ vector)
+            if score >= best_score:
+                best_id, best_score = entry_id, score
+        
+        if best_id is None:
+            return None
+        self.entries.move_to_end(best_id)
+        return self.entries[best_id][1]
+    
+    def store(self, vector: np.ndarray, chunk_ids: frozenset, response: GenerationResponse):
+        """Cache a generated response, evicting the least recently used entry when full."""
+        bucket_keys = self._bucket_keys(vector, chunk_ids)
+        entry_id = self.next_id
+        self.next_id += 1
+        self.entries[entry_id] = (vector, response, time.monotonic() + self.ttl_seconds, bucket_keys)
+        for key in bucket_keys:
+            self.buckets.setdefault(key, set()).add(entry_id)
+        while len(self.entries) > self.max_entries:
+            self._evict(next(iter(self.entries)))
+
+class LLMBatcher:
+    """Coalesce concurrent LLM calls into micro-batches dispatched together.
+    
+    Requests arriving within `window_seconds` of the first queued one (up to
+    `max_batch`) are started together, each as its own `llm.ainvoke` task over
+    the client's shared connection pool. Every request is resolved as soon as its
+    own call finishes, so a short answer is never held back by a long one.
+    """
+    
+    def __init__(self, llm, max_batch: int = 16, window_seconds: float = 0.02):
+        self.llm = llm
+        self.max_batch = max_batch
+        self.window_seconds = window_seconds
+        self.queue: Optional[asyncio.Queue] = None
+        self.worker: Optional[asyncio.Task] = None
+        self.inflight: set = set()
+    
+    async def invoke(self, messages: List):
+        """Queue a prompt for the next batch and wait for its LLM response."""
+        if self.worker is None or self.worker.done():
+            self.queue = asyncio.Queue()
+            self.worker = asyncio.create_task(self._collect())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((messages, future))
+        return await future
+    
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window_seconds
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Dispatch without waiting so the next window can start collecting immediately
+            self._dispatch(batch)
+    
+    def _dispatch(self, batch: List[tuple]):
+        for messages, future in batch:
+            if future.done():
+                continue
+            task = asyncio.create_task(self.llm.ainvoke(messages))
+            self.inflight.add(task)
+            task.add_done_callback(self.inflight.discard)
+            task.add_done_callback(functools.partial(self._resolve, future))
+            # A caller that gave up (e.g. client disconnect) cancels its own call only
+            future.add_done_callback(lambda f, task=task: task.cancel() if f.cancelled() else None)
+    
+    @staticmethod
+    def _resolve(future: asyncio.Future, task: asyncio.Task):
+        if future.done():
+            return
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+class LLMOverloadedError(Exception):
+    """Raised when too many requests are already waiting for an LLM slot."""
+
+class LLMConcurrencyLimiter:
+    """Bound concurrent LLM calls per process and shed load once the wait queue is full.
+    
+    Up to `max_inflight` calls run at once and up to `max_waiting` more may be admitted
+    behind them; further callers are rejected with LLMOverloadedError. A request counts
+    from the moment it is admitted, so work done before its LLM call (such as embedding
+    the question) already takes up capacity and a burst cannot all slip past the check.
+    """
+    
+    def __init__(self, max_inflight: int, max_waiting: int):
+        self.semaphore = asyncio.Semaphore(max_inflight)
+        self.capacity = max_inflight + max_waiting
+        self.admitted = 0
+    
+    def overloaded(self) -> bool:
+        return self.admitted >= self.capacity
+    
+    def admit(self):
+        """Reserve a place for a request; pair with `leave` once it is finished."""
+        if self.overloaded():
+            raise LLMOverloadedError("Too many generation requests in progress")
+        self.admitted += 1
+    
+    def leave(self):
+        self.admitted -= 1
+    
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Admit a request and hold an in-flight slot for the duration of its LLM call."""
+        self.admit()
+        try:
+            async with self.semaphore:
+                yield
+        finally:
+            self.leave()
+
 class PermissionAwareResponse:
     @staticmethod
     def generate_permission_message(user, denied_chunks_count, question):
@@ -77,256 +450,348 @@ class PermissionAwareResponse:
 class EnhancedRAGAgent:
     def __init__(self):
         self.llm = llm
-    
-    def analyze_conversation_context(self, question: str, conversation_history: List[ConversationMessage]) -> Dict[str, Any]:
-        """Analyze the conversation to understand context and intent."""
-        analysis = {
-            'is_follow_up': False,
-            'question_type': 'new',
-            'previous_topics': [],
-            'context_needed': False,
-            'summary_request': False
-        }
-        
-        if not conversation_history:
-            return analysis
-        
-        question_lower = question.lower().strip()
-        
-        # Detect follow-up patterns
-        follow_up_patterns = [
-            'and in total', 'in total', 'total?', 'overall?', 'combined?',
-            'and what about', 'what about', 'also', 'additionally',
-            'tell me more', 'more details', 'elaborate'
-        ]
-        
-        analysis['is_follow_up'] = (
-            any(pattern in question_lower for pattern in follow_up_patterns) or
-            len(question.split()) <= 5 or
-            question_lower.startswith(('and ', 'also ', 'what about ', 'how about '))
+        self.batcher = LLMBatcher(llm)
+        self.limiter = LLMConcurrencyLimiter(
+            max_inflight=int(os.getenv("MAX_INFLIGHT", 32)),
+            max_waiting=int(os.getenv("MAX_QUEUED", 256))
         )
+        self.embeddings = embeddings
+        self.cache = SemanticCache()
+    
+    async def embed_question(self, question: str) -> Optional[np.ndarray]:
+        """Embed and L2-normalise a question; None if embedding is unavailable."""
+        try:
+            vector = np.asarray(await self.embeddings.aembed_query(question), dtype=np.float32)
+        except Exception as e:
+            log.warning("question embedding failed", extra={"error": str(e)})
+            return None
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+    
+    @staticmethod
+    def recent_history(conversation_history: Optional[List[ConversationMessage]], max_history: int) -> List[ConversationMessage]:
+        """Take the last `max_history` messages once so downstream steps share one copy."""
+        if not conversation_history or max_history <= 0:
+            return []
+        return conversation_history[-max_history:]
+    
+    def analyze_conversation_context(self, question: str, history_tail: List[ConversationMessage]) -> Dict[str, Any]:
+        """Analyze the conversation to understand context and intent.
         
-        # Identify if it's a summary/total request
-        analysis['summary_request'] = any(word in question_lower for word in ['total', 'overall', 'combined', 'sum', 'altogether'])
-        
-        # Extract topics from recent conversation
-        recent_messages = conversation_history[-6:]  # Last 3 exchanges
-        topics = set()
-        
-        for msg in recent_messages:
-            content_lower = msg.content.lower()
-            # Extract key domain topics
-            if any(word in content_lower for word in ['charity', 'charitable', 'donation', 'donated']):
-                topics.add('charitable_giving')
-            if any(word in content_lower for word in ['insurance', 'policy', 'coverage', 'claim']):
-                topics.add('insurance')
-            if any(word in content_lower for word in ['travelers', 'company', 'corporation']):
-                topics.add('company_info')
-            if any(word in content_lower for word in ['golf', 'tournament', 'championship']):
-                topics.add('golf_sponsorship')
-            if any(word in content_lower for word in ['repurchase', 'acquisition', 'merger']):
-                topics.add('corporate_actions')
-            if any(word in content_lower for word in ['money', 'amount', 'cost', 'expense']):
-                topics.add('financial_data')
-        
-        analysis['previous_topics'] = list(topics)
-        analysis['context_needed'] = analysis['is_follow_up'] and len(topics) > 0
+        `history_tail` is the already-bounded recent history (see `recent_history`).
+        """
+        # Roles are part of the key so the cache never conflates histories
+        history_key = tuple((msg.role, msg.content) for msg in history_tail)
+        is_follow_up, question_type, previous_topics, context_needed, summary_request = analyze_context_cached(question, history_key)
         
-        return analysis
+        return {
+            'is_follow_up': is_follow_up,
+            'question_type': question_type,
+            'previous_topics': list(previous_topics),
+            'context_needed': context_needed,
+            'summary_request': summary_request
+        }
     
     def build_contextual_prompt(self, question: str, chunks: List[RetrievedChunk], 
-                               conversation_history: List[ConversationMessage], 
+                               history_tail: List[ConversationMessage], 
                                context_analysis: Dict[str, Any]) -> List:
         """Build a contextual prompt that leverages conversation history and retrieved information."""
         
+        is_follow_up = context_analysis['is_follow_up']
+        
+        # All dynamic context is collected into one list and joined once
+        parts = ["CONTEXT:\n"]
+        
         # Prepare conversation context
-        conversation_context = ""
-        if conversation_history and context_analysis['is_follow_up']:
-            conversation_context = "PREVIOUS CONVERSATION:\n"
-            # Include last 3 exchanges for context
-            for msg in conversation_history[-6:]:
-                role_label = "USER" if msg.role == "user" else "ASSISTANT"
-                conversation_context += f"{role_label}: {msg.content}\n"
-            conversation_context += "\n"
+        if history_tail and is_follow_up:
+            parts.append("PREVIOUS CONVERSATION:\n")
+            for msg in history_tail:
+                parts.append(f"{ROLE_LABELS.get(msg.role, 'ASSISTANT')}: {msg.content}\n")
+            parts.append("\n")
         
         # Prepare retrieved information context
-        info_context = "RETRIEVED INFORMATION:\n"
+        parts.append("RETRIEVED INFORMATION:\n")
         for i, chunk in enumerate(chunks[:5], 1):
-            chunk_preview = chunk.text[:300] + "..." if len(chunk.text) > 300 else chunk.text
-            info_context += f"[Source {i} - ID: {chunk.id}]\n{chunk_preview}\n\n"
+            parts.append(f"[Source {i} - ID: {chunk.id}]\n{chunk.preview}\n\n")
         
-        # Create appropriate system message based on context
-        if context_analysis['is_follow_up']:
-            if context_analysis['summary_request']:
-                system_message = """You are an AI assistant with access to conversation history and retrieved documents.
-
-The user is asking for summary/total information as a follow-up to the previous conversation. Your task is to:
-
-1. Review the previous conversation to understand what topic they're asking about
-2. Look through ALL retrieved information for comprehensive data related to that topic
-3. Provide a complete answer that synthesizes information across multiple sources
-4. If asking for totals/sums, look for numerical data and add them up if appropriate
-5. Be thorough but concise
-
-IMPORTANT: Use both the conversation history AND retrieved information to provide a complete answer."""
-
-            else:
-                system_message = """You are an AI assistant with access to conversation history and retrieved documents.
-
-This is a follow-up question building on the previous conversation. Your task is to:
-
-1. Consider the context from the previous conversation
-2. Use the retrieved information to extend or clarify the previous discussion
-3. Provide additional relevant details that build on what was already discussed
-4. Maintain continuity with the previous conversation
-
-Be direct and informative while building on the established context."""
-
-        else:
-            system_message = """You are an AI assistant answering questions based on retrieved documents.
-
-Provide a direct, comprehensive answer to the user's question using the retrieved information.
-
-Guidelines:
-- Answer the question completely and accurately
-- Use specific details from the retrieved sources
-- Be concise but thorough
-- If multiple sources contain relevant information, synthesize them appropriately"""
-        
-        # Combine all context
-        full_context = f"{conversation_context}{info_context}"
+        # Pick the prebuilt static instructions; dynamic context goes in its own message so the
+        # system prefix stays byte-identical across calls (see STATIC_SYSTEM_PROMPTS)
+        system_message = (
+            (SYSTEM_MESSAGE_FOLLOW_UP_SUMMARY if context_analysis['summary_request'] else SYSTEM_MESSAGE_FOLLOW_UP)
+            if is_follow_up else SYSTEM_MESSAGE_NEW
+        )
         
         messages = [
-            SystemMessage(content=f"{system_message}\n\nCONTEXT:\n{full_context}"),
+            system_message,
+            SystemMessage(content="".join(parts)),
             HumanMessage(content=f"Current question: {question}")
         ]
         
         return messages
     
-    def generate_response(self, question: str, chunks: List[RetrievedChunk], 
-                         session_id: str = None, conversation_history: List[ConversationMessage] = None) -> GenerationResponse:
-        """Generate enhanced response with full conversation awareness."""
-        
-        if not conversation_history:
-            conversation_history = []
-        
-        # Analyze the conversation context
-        context_analysis = self.analyze_conversation_context(question, conversation_history)
+    @staticmethod
+    def extract_tokens_used(response) -> int:
+        """Read total token usage from an LLM message, whichever metadata field carries it."""
+        if getattr(response, 'usage_metadata', None):
+            return response.usage_metadata.get('total_tokens', 0)
+        if getattr(response, 'response_metadata', None):
+            usage = response.response_metadata.get('token_usage', {})
+            return usage.get('total_tokens', 0)
+        return 0
+    
+    async def generate_response(self, question: str, chunks: List[RetrievedChunk], 
+                         session_id: str = None, conversation_history: List[ConversationMessage] = None,
+                         max_history: int = MAX_HISTORY_MESSAGES, debug: bool = False) -> GenerationResponse:
+        """Generate enhanced response with full conversation awareness.
         
-        processing_steps = [
-            f"Analyzing question: '{question}'",
-            f"Conversation history: {len(conversation_history)} messages",
-            f"Retrieved chunks: {len(chunks)}",
-            f"Question type: {context_analysis['question_type']}",
-            f"Is follow-up: {context_analysis['is_follow_up']}",
-            f"Previous topics: {context_analysis['previous_topics']}",
-            f"Summary request: {context_analysis['summary_request']}"
-        ]
+        Processing steps are only recorded when `debug` is set.
+        """
         
+        # Nothing to ground an answer in, so skip analysis entirely
         if not chunks:
-            processing_steps.append("No chunks available - returning no context response")
-            return GenerationResponse(
-                answer="I don't have enough relevant information in the knowledge base to answer your question. Please try rephrasing or ask about a different topic.",
+            return GenerationResponse.model_construct(
+                answer=NO_CONTEXT_ANSWER,
                 tokensUsed=0,
                 model="gpt-3.5-turbo",
-                processingSteps=processing_steps,
-                sessionId=session_id or str(uuid.uuid4()),
+                processingSteps=list(NO_CONTEXT_STEPS) if debug else None,
+                sessionId=session_id or secrets.token_hex(16),
                 needsFollowUp=False
             )
         
+        history_tail = self.recent_history(conversation_history, max_history)
+        
+        # Analyze the conversation context
+        context_analysis = self.analyze_conversation_context(question, history_tail)
+        
+        processing_steps = None
+        if debug:
+            processing_steps = [
+                f"Analyzing question: '{question}'",
+                f"Conversation history: {len(conversation_history or [])} messages",
+                f"Retrieved chunks: {len(chunks)}",
+                f"Question type: {context_analysis['question_type']}",
+                f"Is follow-up: {context_analysis['is_follow_up']}",
+                f"Previous topics: {context_analysis['previous_topics']}",
+                f"Summary request: {context_analysis['summary_request']}"
+            ]
+        
+        # Shed load before paying for an embedding round-trip that would be wasted; the
+        # request holds its admission until it finishes
+        self.limiter.admit()
         try:
+            # Follow-ups depend on the conversation, so only standalone questions are cached
+            question_vector = None
+            chunk_ids = frozenset(chunk.id for chunk in chunks[:5])
+            if not context_analysis['is_follow_up']:
+                question_vector = await self.embed_question(question)
+            if question_vector is not None:
+                cached = self.cache.lookup(question_vector, chunk_ids)
+                if cached is not None:
+                    if debug:
+                        processing_steps.append("semantic cache hit")
+                    return GenerationResponse.model_construct(
+                        answer=cached.answer,
+                        tokensUsed=0,
+                        model=cached.model,
+                        processingSteps=processing_steps,
+                        sessionId=session_id or secrets.token_hex(16),
+                        needsFollowUp=cached.needsFollowUp
+                    )
+            
             # Build contextual prompt
-            messages = self.build_contextual_prompt(question, chunks, conversation_history, context_analysis)
+            messages = self.build_contextual_prompt(question, chunks, history_tail, context_analysis)
             
-            processing_steps.append(f"Generated {len(messages)} contextual messages for LLM")
+            if debug:
+                processing_steps.append(f"Generated {len(messages)} contextual messages for LLM")
             
-            # Get response from LLM
-            response = self.llm.invoke(messages)
+            # Get response from LLM, batched with other in-flight requests. The batcher resolves
+            # each request on its own, so the slot is held for this call only (plus the
+            # batching window), not for the slowest call in the batch
+            async with self.limiter.semaphore:
+                response = await self.batcher.invoke(messages)
             answer = response.content.strip()
             
             # Extract token usage
-            tokens_used = 0
-            if hasattr(response, 'usage_metadata') and response.usage_metadata:
-                tokens_used = response.usage_metadata.get('total_tokens', 0)
-            elif hasattr(response, 'response_metadata') and response.response_metadata:
-                usage = response.response_metadata.get('token_usage', {})
-                tokens_used = usage.get('total_tokens', 0)
+            tokens_used = self.extract_tokens_used(response)
             
-            processing_steps.append(f"Generated response successfully ({tokens_used} tokens)")
-            
-            # Determine if follow-up might be needed
-            needs_follow_up = (
-                'more information' in answer.lower() or 
-                'additional details' in answer.lower() or
-                len(answer.split()) < 20
-            )
+            if debug:
+                processing_steps.append(f"Generated response successfully ({tokens_used} tokens)")
             
-            return GenerationResponse(
+            generation = GenerationResponse.model_construct(
                 answer=answer,
                 tokensUsed=tokens_used,
                 model="gpt-3.5-turbo",
                 processingSteps=processing_steps,
-                sessionId=session_id or str(uuid.uuid4()),
-                needsFollowUp=needs_follow_up
+                sessionId=session_id or secrets.token_hex(16),
+                needsFollowUp=self.needs_follow_up(answer)
             )
+            if question_vector is not None:
+                self.cache.store(question_vector, chunk_ids, generation)
+            
+            return generation
             
         except Exception as e:
-            processing_steps.append(f"Error generating response: {str(e)}")
-            return GenerationResponse(
+            if debug:
+                processing_steps.append(f"Error generating response: {str(e)}")
+            return GenerationResponse.model_construct(
                 answer="I encountered an error while generating a response. Please try rephrasing your question.",
                 tokensUsed=0,
                 model="gpt-3.5-turbo-error",
                 processingSteps=processing_steps,
-                sessionId=session_id or str(uuid.uuid4()),
+                sessionId=session_id or secrets.token_hex(16),
                 needsFollowUp=False
             )
+        finally:
+            self.limiter.leave()
+    
+    async def stream_response(self, question: str, chunks: List[RetrievedChunk], 
+                              session_id: str = None, conversation_history: List[ConversationMessage] = None,
+                              max_history: int = MAX_HISTORY_MESSAGES) -> AsyncIterator[str]:
+        """Stream the answer as server-sent events, finishing with a summary event."""
+        
+        session_id = session_id or secrets.token_hex(16)
+        
+        if not chunks:
+            yield sse_event({'token': NO_CONTEXT_ANSWER})
+            yield sse_event({
+                'done': True,
+                'tokensUsed': 0,
+                'model': "gpt-3.5-turbo",
+                'sessionId': session_id,
+                'needsFollowUp': False
+            })
+            return
+        
+        history_tail = self.recent_history(conversation_history, max_history)
+        context_analysis = self.analyze_conversation_context(question, history_tail)
+        messages = self.build_contextual_prompt(question, chunks, history_tail, context_analysis)
+        
+        answer_parts = []
+        aggregate = None
+        try:
+            async with self.limiter.slot():
+                # Without include_usage the final usage chunk is dropped and tokensUsed stays 0
+                async for chunk in self.llm.astream(messages, stream_options={"include_usage": True}):
+                    aggregate = chunk if aggregate is None else aggregate + chunk
+                    if chunk.content:
+                        answer_parts.append(chunk.content)
+                        yield sse_event({'token': chunk.content})
+        except Exception as e:
+            yield sse_event({'error': f"Generation failed: {str(e)}", 'done': True, 'sessionId': session_id})
+            return
+        
+        answer = "".join(answer_parts).strip()
+        yield sse_event({
+            'done': True,
+            'tokensUsed': self.extract_tokens_used(aggregate),
+            'model': "gpt-3.5-turbo",
+            'sessionId': session_id,
+            'needsFollowUp': self.needs_follow_up(answer)
+        })
+    
+    @staticmethod
+    def needs_follow_up(answer: str) -> bool:
+        """Determine if follow-up might be needed."""
+        answer_lower = answer.lower()
+        return (
+            'more information' in answer_lower or 
+            'additional details' in answer_lower or
+            len(answer.split()) < 20
+        )
 
 # Initialize the enhanced agent
 rag_agent = EnhancedRAGAgent()
 
-@app.post("/generate", response_model=GenerationResponse)
-async def generate_response(request: GenerationRequest):
+@app.post("/generate")
+async def generate_response(http_request: Request):
     """Generate a response using the enhanced RAG agent with conversation memory."""
+    request = await decode_generation_request(http_request)
     try:
         if not os.getenv("OPENAI_API_KEY"):
             raise HTTPException(status_code=500, detail="OpenAI API key not configured")
         
-        print(f"Received generation request:")
-        print(f"  Question: {request.question}")
-        print(f"  Chunks: {len(request.retrievedChunks)}")
-        print(f"  History: {len(request.conversationHistory) if request.conversationHistory else 0}")
-        print(f"  Session: {request.sessionId}")
+        log.info("generation request", extra={
+            "question": request.question,
+            "chunks": len(request.retrievedChunks),
+            "history": len(request.conversationHistory or []),
+            "session": request.sessionId
+        })
         
-        response = rag_agent.generate_response(
+        response = await rag_agent.generate_response(
             question=request.question,
             chunks=request.retrievedChunks,
             session_id=request.sessionId,
-            conversation_history=request.conversationHistory or []
+            conversation_history=request.conversationHistory or [],
+            debug=request.debug
         )
         
-        print(f"Generated response: {len(response.answer)} characters, {response.tokensUsed} tokens")
-        return response
+        log.info("generated response", extra={
+            "answer_chars": len(response.answer),
+            "tokens": response.tokensUsed,
+            "session": response.sessionId
+        })
+        return ORJSONResponse(content=response.model_dump(exclude_none=True))
         
+    except LLMOverloadedError as e:
+        log.warning("generation rejected", extra={"error": str(e), "session": request.sessionId})
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
     except Exception as e:
-        session_id = request.sessionId or str(uuid.uuid4())
-        print(f"Generation failed: {str(e)}")
+        log.error("generation failed", extra={"error": str(e), "session": request.sessionId})
         raise HTTPException(status_code=500, detail=f"Generation failed: {str(e)}")
 
+@app.post("/generate/stream")
+async def generate_stream(http_request: Request):
+    """Stream a response token by token as server-sent events."""
+    request = await decode_generation_request(http_request)
+    if not os.getenv("OPENAI_API_KEY"):
+        raise HTTPException(status_code=500, detail="OpenAI API key not configured")
+    # Status can't change once the stream starts, so shed load up front
+    if rag_agent.limiter.overloaded():
+        raise HTTPException(status_code=503, detail="Too many generation requests in progress", headers={"Retry-After": "1"})
+    
+    log.info("streaming request", extra={
+        "chunks": len(request.retrievedChunks),
+        "history": len(request.conversationHistory or []),
+        "session": request.sessionId
+    })
+    
+    return StreamingResponse(
+        rag_agent.stream_response(
+            question=request.question,
+            chunks=request.retrievedChunks,
+            session_id=request.sessionId,
+            conversation_history=request.conversationHistory or []
+        ),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Environment is fixed for the life of the process, so the health body is serialized once
+HEALTH_BODY = orjson.dumps({
+    "status": "healthy",
+    "service": "Enhanced RAG AI Service",
+    "version": "1.1.0",
+    "openai_configured": bool(os.getenv("OPENAI_API_KEY")),
+    "langsmith_configured": bool(os.getenv("LANGCHAIN_API_KEY")),
+    "langsmith_project": os.getenv("LANGCHAIN_PROJECT", "rag-system"),
+    "langsmith_tracing": os.getenv("LANGCHAIN_TRACING_V2", "false"),
+    "model": "gpt-3.5-turbo",
+    "features": ["conversation_history", "context_analysis", "follow_up_detection", "streaming", "semantic_cache"]
+})
+
 @app.get("/health")
 async def health_check():
     """Enhanced health check endpoint."""
-    return {
-        "status": "healthy",
-        "service": "Enhanced RAG AI Service",
-        "version": "1.1.0",
-        "openai_configured": bool(os.getenv("OPENAI_API_KEY")),
-        "langsmith_configured": bool(os.getenv("LANGCHAIN_API_KEY")),
-        "langsmith_project": os.getenv("LANGCHAIN_PROJECT", "rag-system"),
-        "langsmith_tracing": os.getenv("LANGCHAIN_TRACING_V2", "false"),
-        "model": "gpt-3.5-turbo",
-        "features": ["conversation_history", "context_analysis", "follow_up_detection"]
-    }
+    return Response(content=HEALTH_BODY, media_type="application/json")
 
 if __name__ == "__main__":
     port = int(os.getenv("AI_PORT", 8001))
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    # uvloop is unavailable on Windows; fall back to the default asyncio loop there
+    uvicorn.run(
+        "ai_service:app",
+        host="0.0.0.0",
+        port=port,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    )
\ No newline at end of file